@@ -1,6 +1,7 @@
 # frontend.py (updated to display answers + citations, and support Docker via ZANIA_API_URL)
 
 import os
+import orjson
 import streamlit as st
 import requests
 
@@ -33,6 +34,22 @@ def _render_citations(citations):
         else:
             st.caption(f"[{i}] {src} (page {page})")
 
+def _render_answer(question, payload):
+    """Render one question's answer + citations as soon as it arrives."""
+    if isinstance(payload, dict):
+        answer_text = payload.get("answer", "")
+        citations = payload.get("citations", []) or []
+    else:
+        # Backward compatibility if backend returns a string
+        answer_text = str(payload)
+        citations = []
+
+    with st.expander(f"❓ {question}", expanded=True):
+        st.markdown(answer_text if answer_text else "_No answer returned._")
+        st.divider()
+        st.subheader("Citations")
+        _render_citations(citations)
+
 if st.button("Generate Answers", type="primary"):
     if not (doc_file and q_file):
         st.warning("Please upload both a document and a questions file.")
@@ -45,30 +62,20 @@ if st.button("Generate Answers", type="primary"):
                 "questions_file": (q_file.name, q_file.getvalue(), q_file.type),
             }
 
-            response = requests.post(API_URL, files=files, timeout=120)
+            # Backend streams one {question: payload} JSON line per answer as each completes.
+            # The read timeout applies between lines, not to the whole batch.
+            with requests.post(API_URL, files=files, stream=True, timeout=(10, 120)) as response:
+                if response.status_code != 200:
+                    st.error(f"Error {response.status_code}: {response.text}")
+                    st.stop()
 
-            if response.status_code != 200:
-                st.error(f"Error {response.status_code}: {response.text}")
-                st.stop()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    for question, payload in orjson.loads(line).items():
+                        _render_answer(question, payload)
 
             st.success("Analysis Complete!")
-            results = response.json()
-
-            # Results: {question: {"answer": str, "citations": [...]}}
-            for question, payload in results.items():
-                if isinstance(payload, dict):
-                    answer_text = payload.get("answer", "")
-                    citations = payload.get("citations", []) or []
-                else:
-                    # Backward compatibility if backend returns a string
-                    answer_text = str(payload)
-                    citations = []
-
-                with st.expander(f"❓ {question}", expanded=True):
-                    st.markdown(answer_text if answer_text else "_No answer returned._")
-                    st.divider()
-                    st.subheader("Citations")
-                    _render_citations(citations)
 
         except requests.exceptions.Timeout:
             st.error("Request timed out. Is the backend under load or not running?")
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+
+class LLMCache:
+    """
+    Answer cache for the QA model. Answers are deterministic (temperature=0) for a given document
+    and question, so they are safe to reuse. Entries are scoped per document (its content hash):
+      - exact: LRU of (document, question) -> response
+      - semantic: per-document IndexFlatIP over L2-normalized question embeddings; a near-identical
+        question (cosine >= similarity_threshold) reuses the stored response
+    Bounds: max_entries responses in the exact LRU; at most max_similar_per_document questions for each of
+    max_documents documents in the semantic layer (32 x 32 by default, the same 1024 as the exact layer).
+    Responses hold their retrieved chunks, so these caps also bound chunks kept alive for evicted stores.
+    Not thread-safe: only used from the event loop.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_documents: int = 32,
+        max_similar_per_document: int = 32,
+        similarity_threshold: float = 0.97,
+    ):
+        self.max_entries = max_entries
+        self.max_documents = max_documents
+        self.max_similar_per_document = max_similar_per_document
+        self.similarity_threshold = similarity_threshold
+        self._exact: "OrderedDict[Tuple[str, str], dict]" = OrderedDict()
+        self._semantic: "OrderedDict[str, Tuple[faiss.IndexFlatIP, List[dict]]]" = OrderedDict()
+
+    def get(self, doc_key: str, question: str) -> Optional[dict]:
+        """Exact-match lookup; no embedding needed."""
+        response = self._exact.get((doc_key, question))
+        if response is not None:
+            self._exact.move_to_end((doc_key, question))
+        return response
+
+    def get_similar(self, doc_key: str, question_vector) -> Optional[dict]:
+        """Return the response for the most similar cached question of this document, if similar enough."""
+        entry = self._semantic.get(doc_key)
+        if entry is None or entry[0].ntotal == 0:
+            return None
+        self._semantic.move_to_end(doc_key)
+
+        index, responses = entry
+        scores, ids = index.search(self._normalize(question_vector), 1)
+        if ids[0][0] < 0 or scores[0][0] < self.similarity_threshold:
+            return None
+        return responses[ids[0][0]]
+
+    def put(self, doc_key: str, question: str, question_vector, response: dict) -> None:
+        self._exact[(doc_key, question)] = response
+        self._exact.move_to_end((doc_key, question))
+        while len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)
+
+        vector = self._normalize(question_vector)
+        entry = self._semantic.get(doc_key)
+        if entry is None:
+            entry = (faiss.IndexFlatIP(vector.shape[1]), [])
+            self._semantic[doc_key] = entry
+        self._semantic.move_to_end(doc_key)
+
+        index, responses = entry
+        if index.ntotal >= self.max_similar_per_document:
+            # Flat index ids are positions: dropping id 0 shifts the rest down, like the list
+            index.remove_ids(np.array([0], dtype=np.int64))
+            responses.pop(0)
+        index.add(vector)
+        responses.append(response)
+
+        while len(self._semantic) > self.max_documents:
+            self._semantic.popitem(last=False)
+
+    def group_similar(self, question_vectors) -> List[int]:
+        """
+        For each vector, the position of the first earlier vector it is near-identical to (itself if none),
+        so a batch can answer a group of near-duplicate questions with one call.
+        """
+        vectors = np.array(question_vectors, dtype=np.float32).reshape(len(question_vectors), -1)
+        faiss.normalize_L2(vectors)
+        scores = vectors @ vectors.T
+        leaders: List[int] = []
+        for i in range(len(vectors)):
+            similar = (j for j in range(i) if leaders[j] == j and scores[i, j] >= self.similarity_threshold)
+            leaders.append(next(similar, i))
+        return leaders
+
+    def clear(self) -> None:
+        self._exact.clear()
+        self._semantic.clear()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        v = np.array(vector, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(v)
+        return v
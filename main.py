@@ -5,26 +5,76 @@ load_dotenv()  # loads OPENAI_API_KEY from .env if present
 
 import os
 import re
-import json
 import tempfile
 import asyncio
 import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional, Tuple
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import numpy as np
+import orjson
+
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from utils import (
     logger,
     validate_file,
     validate_questions_file,
-    save_upload_to_path,
-    executor,
+    save_and_validate,
+    read_and_validate,
+    io_executor,
     MAX_QUESTIONS,
+    MAX_CONCURRENT_LLM_CALLS,
+    MAX_REQUEST_SIZE_MB,
+    MAX_CACHED_STORES,
+)
+from rag_engine import (
+    process_file_sync,
+    load_cached_knowledge_base,
+    build_knowledge_base,
+    build_retriever,
+    get_openai_client,
+    get_embeddings_model,
+    embed_questions,
+    retrieve_documents,
+    answer_question,
 )
-from rag_engine import process_file_sync, build_rag_pipeline, resilient_llm_call
+from llm_cache import LLMCache
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the shared OpenAI clients at boot so the first request doesn't pay for it
+    try:
+        get_openai_client()
+        get_embeddings_model()
+    except Exception as e:
+        logger.error(f"Failed to initialize OpenAI clients: {e}")
+    yield
+
 
-app = FastAPI(title="Zania Q&A Bot", description="Async RAG Architecture v2")
+app = FastAPI(title="Zania Q&A Bot", description="Async RAG Architecture v2", lifespan=lifespan)
 
+MAX_REQUEST_SIZE_BYTES = MAX_REQUEST_SIZE_MB * 1024 * 1024
+
+@app.middleware("http")
+async def reject_oversized_requests(request: Request, call_next):
+    """
+    Reject oversized uploads from the Content-Length header alone.
+    By the time /answer runs, FastAPI has already read and spooled the whole multipart body.
+    """
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_REQUEST_SIZE_BYTES:
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"Request too large. Limit is {MAX_REQUEST_SIZE_MB}MB"},
+        )
+    return await call_next(request)
+
+# Registered last so it wraps everything (including 413s) with CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -32,6 +82,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+NOT_FOUND_ANSWER = "Not found in the provided document."
+# "Not found" is only retried with a wider search when retrieval covered fewer pages than this
+MIN_RETRIEVED_PAGES = 3
+
+# Answers by (document, question), plus near-duplicate question matching per document
+llm_cache = LLMCache()
+
+# In-memory vector stores by document hash, in LRU order. The Event is set once the store is built.
+# Only touched from the event loop, so check-and-insert (no await in between) needs no lock.
+_STORE_CACHE: "OrderedDict[str, Tuple[Optional[object], asyncio.Event]]" = OrderedDict()
+# Up to 6 digits: real page numbers, and always within int64 for the vectorized citation filter
+_PAGE_RE = re.compile(r"\bpage\s*=?\s*(\d{1,6})\b", re.IGNORECASE)
+
 def _pages_mentioned(answer_text: str) -> set:
     """
     Extract page numbers mentioned by the model in Evidence lines.
@@ -41,13 +104,7 @@ def _pages_mentioned(answer_text: str) -> set:
       - page 48
       - page= 48
     """
-    pages = set()
-    for m in re.finditer(r"\bpage\s*=?\s*(\d+)\b", answer_text, flags=re.IGNORECASE):
-        try:
-            pages.add(int(m.group(1)))
-        except Exception:
-            pass
-    return pages
+    return {int(m.group(1)) for m in _PAGE_RE.finditer(answer_text)}
 
 def _coerce_int(v):
     try:
@@ -55,6 +112,107 @@ def _coerce_int(v):
     except Exception:
         return None
 
+def _widen_retrieval(retriever) -> dict:
+    """
+    Search kwargs with a larger k/fetch_k, passed per call.
+    The shared retriever is left untouched so concurrent questions don't see each other's retries.
+    """
+    search_kwargs = retriever.search_kwargs
+    return {
+        "k": max(search_kwargs.get("k", 8), 16),
+        # Only meaningful if your retriever uses fetch_k; safe to set regardless
+        "fetch_k": max(search_kwargs.get("fetch_k", 40), 80),
+    }
+
+def _retrieval_is_sparse(response: dict) -> bool:
+    """
+    True when the retrieved chunks span few distinct pages, so a wider search could still surface the answer.
+    With good page coverage a "Not found" is taken as genuine and the second LLM call is skipped.
+    """
+    pages = {(d.metadata or {}).get("page") for d in response.get("source_documents", []) or []}
+    return len(pages) < MIN_RETRIEVED_PAGES
+
+def _postprocess(response: dict, source_name: str) -> dict:
+    """
+    Turn a raw answer_question response into the {"answer", "citations"} payload returned to the client.
+    Citations name this request's upload (source_name): indexed chunks are shared across uploads and carry no name.
+    """
+    answer = (response.get("result", "") or "").strip()
+
+    # Clean citations:
+    #  - If the model mentioned pages in Evidence, keep only those pages
+    #  - Dedupe pages
+    #  - Cap to 4 citations
+    # Fallback: if Evidence didn't include page numbers or filtering removed everything,
+    # take top 4 unique retrieved chunks. Both lists are built in one pass.
+    pages_used = _pages_mentioned(answer)
+
+    # Load metadata once into parallel arrays, then filter pages in one vectorized pass
+    source_docs = response.get("source_documents", []) or []
+    pages = [_coerce_int((d.metadata or {}).get("page")) for d in source_docs]
+
+    if pages_used:
+        page_arr = np.fromiter((-1 if p is None else p for p in pages), dtype=np.int64, count=len(pages))
+        # Chunks without a page number can't contradict the Evidence, so they stay
+        keep = np.isin(page_arr, list(pages_used)) | (page_arr == -1)
+    else:
+        keep = np.ones(len(pages), dtype=bool)
+
+    seen_filtered, seen_all = set(), set()
+    filtered, unfiltered = [], []
+    for i, page in enumerate(pages):
+        if page not in seen_all and len(unfiltered) < 4:
+            seen_all.add(page)
+            unfiltered.append({"source": source_name, "page": page})
+
+        if keep[i] and page not in seen_filtered:
+            seen_filtered.add(page)
+            filtered.append({"source": source_name, "page": page})
+            if len(filtered) == 4:
+                break
+
+    citations = filtered or unfiltered
+
+    return {
+        "answer": answer if answer else NOT_FOUND_ANSWER,
+        "citations": citations,
+    }
+
+async def _get_knowledge_base(doc_hash: str, build: Callable[[], Awaitable[object]]):
+    """
+    Return the shared vector store for this document, building it at most once.
+    Concurrent requests for the same document wait for the first one's build instead of re-embedding.
+    """
+    while doc_hash in _STORE_CACHE:
+        store, ready = _STORE_CACHE[doc_hash]
+        if store is not None:
+            _STORE_CACHE.move_to_end(doc_hash)
+            return store
+        await ready.wait()
+        # If that build failed its entry is gone and we fall through to build it ourselves
+
+    ready = asyncio.Event()
+    _STORE_CACHE[doc_hash] = (None, ready)
+    try:
+        store = await build()
+        _STORE_CACHE[doc_hash] = (store, ready)
+        # The placeholder kept its insertion slot; other stores may have been used during the build
+        _STORE_CACHE.move_to_end(doc_hash)
+    except BaseException:
+        _STORE_CACHE.pop(doc_hash, None)
+        raise
+    finally:
+        ready.set()
+
+    # Evict least recently used stores (never ones still being built, nor the one just built)
+    for key in list(_STORE_CACHE):
+        if len(_STORE_CACHE) <= MAX_CACHED_STORES:
+            break
+        if key != doc_hash and _STORE_CACHE[key][0] is not None:
+            del _STORE_CACHE[key]
+
+    return store
+
 @app.get("/health")
 def health_check():
     return {"status": "active", "version": "2.0"}
@@ -66,139 +224,162 @@ async def generate_answers(
 ):
     start_time = time.time()
 
-    # 1) VALIDATION
+    # 1) VALIDATION (file types; size caps are enforced while each upload is read)
     doc_ext = validate_file(document_file)
     validate_questions_file(questions_file)
 
+    # 2) LOAD + VALIDATE QUESTIONS EARLY (parsed in memory; fail-fast before touching the document)
+    try:
+        q_data = orjson.loads(await read_and_validate(questions_file))
+    except orjson.JSONDecodeError:
+        raise HTTPException(
+            status_code=400,
+            detail='Invalid questions JSON. Provide a JSON array or {"questions": [...]} object.',
+        )
+
+    questions = q_data if isinstance(q_data, list) else q_data.get("questions", [])
+    if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        raise HTTPException(status_code=400, detail="Questions must be a list of strings.")
+
+    # Each distinct question is answered (and streamed) once
+    questions = list(dict.fromkeys(q.strip() for q in questions if q.strip()))
+    if not questions:
+        raise HTTPException(status_code=400, detail="No questions provided.")
+    if len(questions) > MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Too many questions. Limit is {MAX_QUESTIONS}.")
+
+    # The temp dir only has to outlive document processing; answers are generated from the index
     with tempfile.TemporaryDirectory() as temp_work_dir:
         local_doc_path = os.path.join(temp_work_dir, f"source_doc{doc_ext}")
-        local_q_path = os.path.join(temp_work_dir, "questions.json")
 
-        # 2) SAVE UPLOADS (async offload)
+        # 3) STREAM DOCUMENT TO DISK (the PDF parser needs a real path); oversized uploads stop at the cap
         loop = asyncio.get_running_loop()
         try:
-            await loop.run_in_executor(executor, save_upload_to_path, document_file, local_doc_path)
-            await loop.run_in_executor(executor, save_upload_to_path, questions_file, local_q_path)
+            doc_hash = await save_and_validate(document_file, local_doc_path)
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"File write error: {e}")
             raise HTTPException(status_code=500, detail="Server failed to save upload.")
 
-        # 3) LOAD + VALIDATE QUESTIONS EARLY (fail-fast before expensive embedding)
+        # 4) SHARED IN-MEMORY STORE, ELSE ON-DISK INDEX, ELSE PROCESS + EMBED DOCUMENT (thread offload)
+        async def _load_or_build():
+            knowledge_base = await loop.run_in_executor(io_executor, load_cached_knowledge_base, doc_hash)
+            if knowledge_base is not None:
+                return knowledge_base
+
+            raw_documents = await loop.run_in_executor(io_executor, process_file_sync, local_doc_path, doc_ext)
+            return await build_knowledge_base(raw_documents, doc_hash)
+
+        knowledge_base = await _get_knowledge_base(doc_hash, _load_or_build)
+
+    # 5) BUILD RETRIEVER
+    retriever = build_retriever(knowledge_base)
+    openai_client = get_openai_client()
+
+    # Shared stores/indexes are keyed by content only; the upload name is applied per request. The model
+    # sees it in context labels and may echo it, so answers are cached per (content, name).
+    source_name = document_file.filename or "document"
+    answer_key = f"{doc_hash}/{source_name}"
+
+    # 6) CACHED ANSWERS, THEN ONE EMBEDDINGS REQUEST + ONE FAISS SEARCH FOR ALL REMAINING QUESTIONS
+    answered = {}
+    for q in questions:
+        cached = llm_cache.get(answer_key, q)
+        if cached is not None:
+            answered[q] = cached
+    pending = [q for q in questions if q not in answered]
+
+    # same_as: near-duplicate question in this batch -> the question whose answer it shares
+    question_vectors, retrieved, same_as = {}, {}, {}
+    if pending:
+        try:
+            pending_vectors = await embed_questions(pending)
+            to_search = []
+            for q, q_vec in zip(pending, pending_vectors):
+                question_vectors[q] = q_vec
+                cached = llm_cache.get_similar(answer_key, q_vec)
+                if cached is not None:
+                    answered[q] = cached
+                else:
+                    to_search.append(q)
+
+            if to_search:
+                leaders = llm_cache.group_similar([question_vectors[q] for q in to_search])
+                same_as = {q: to_search[i] for q, i in zip(to_search, leaders) if q != to_search[i]}
+                to_search = [q for q in to_search if q not in same_as]
+                docs_per_question = await loop.run_in_executor(
+                    io_executor, retrieve_documents, retriever, np.stack([question_vectors[q] for q in to_search])
+                )
+                retrieved = dict(zip(to_search, docs_per_question))
+        except Exception as e:
+            # Unretrieved questions get the per-question error payload below
+            logger.error(f"Retrieval error: {e}")
+
+    # 7) ANSWER QUESTIONS CONCURRENTLY on the event loop (bounded to stay under OpenAI rate limits)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+
+    shared_answers = {}
+
+    def _ask_once(q: str) -> asyncio.Future:
+        if q not in shared_answers:
+            shared_answers[q] = asyncio.ensure_future(_ask(q))
+        return shared_answers[q]
+
+    async def _ask(q: str):
+        if q in answered:
+            return answered[q]
+        if q in same_as:
+            response = await _ask_once(same_as[q])
+            llm_cache.put(answer_key, q, question_vectors[q], response)
+            return response
+        if q not in retrieved:
+            raise RuntimeError("No context retrieved")
+
+        async with semaphore:
+            response = await answer_question(openai_client, q, retrieved[q], source_name)
+            answer = (response.get("result", "") or "").strip()
+
+            # Optional second pass: if explicitly not found from sparse context, increase recall and retry once
+            if answer == NOT_FOUND_ANSWER and _retrieval_is_sparse(response):
+                try:
+                    wider_docs = await loop.run_in_executor(
+                        io_executor, retrieve_documents, retriever, question_vectors[q], _widen_retrieval(retriever)
+                    )
+                    response2 = await answer_question(openai_client, q, wider_docs[0], source_name)
+                    answer2 = (response2.get("result", "") or "").strip()
+                    if answer2 and answer2 != NOT_FOUND_ANSWER:
+                        response = response2
+                except Exception:
+                    pass
+
+            llm_cache.put(answer_key, q, question_vectors[q], response)
+            return response
+
+    async def _answer(q: str):
+        try:
+            return q, _postprocess(await _ask_once(q), source_name)
+        except Exception as e:
+            logger.error(f"LLM Error on question '{q}': {e}")
+            return q, {"answer": "Error: Service unavailable for this query.", "citations": []}
+
+    # 8) STREAM RESULTS: one {question: payload} JSON line per question, in completion order
+    async def _stream():
+        tasks = [asyncio.ensure_future(_answer(q)) for q in questions]
         try:
-            with open(local_q_path, "r", encoding="utf-8") as f:
-                q_data = json.load(f)
-        except json.JSONDecodeError:
-            raise HTTPException(
-                status_code=400,
-                detail='Invalid questions JSON. Provide a JSON array or {"questions": [...]} object.',
-            )
-
-        questions = q_data if isinstance(q_data, list) else q_data.get("questions", [])
-        if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
-            raise HTTPException(status_code=400, detail="Questions must be a list of strings.")
-
-        questions = [q.strip() for q in questions if q.strip()]
-        if not questions:
-            raise HTTPException(status_code=400, detail="No questions provided.")
-        if len(questions) > MAX_QUESTIONS:
-            raise HTTPException(status_code=400, detail=f"Too many questions. Limit is {MAX_QUESTIONS}.")
-
-        # 4) PROCESS DOCUMENT (thread offload)
-        raw_documents = await loop.run_in_executor(executor, process_file_sync, local_doc_path, doc_ext)
-
-        # Normalize citation source to original uploaded filename (avoid temp paths)
-        original_name = document_file.filename or "document"
-        for d in raw_documents:
-            try:
-                d.metadata["source"] = original_name
-            except Exception:
-                pass
-
-        # 5) BUILD RAG PIPELINE (thread offload)
-        rag_pipeline = await loop.run_in_executor(executor, build_rag_pipeline, raw_documents)
-
-        # 6) ANSWER QUESTIONS + RETURN CITATIONS (clean + capped)
-        results = {}
-        for q in questions:
-            try:
-                response = await loop.run_in_executor(executor, resilient_llm_call, rag_pipeline, q)
-                answer = (response.get("result", "") or "").strip()
-
-                # Optional second pass: if explicitly not found, increase recall and retry once
-                if answer == "Not found in the provided document.":
-                    try:
-                        # Works if your rag_pipeline exposes retriever.search_kwargs (LangChain RetrievalQA does)
-                        rag_pipeline.retriever.search_kwargs["k"] = max(
-                            rag_pipeline.retriever.search_kwargs.get("k", 8), 16
-                        )
-                        # Only meaningful if your retriever uses fetch_k; safe to set regardless
-                        rag_pipeline.retriever.search_kwargs["fetch_k"] = max(
-                            rag_pipeline.retriever.search_kwargs.get("fetch_k", 40), 80
-                        )
-
-                        response2 = await loop.run_in_executor(executor, resilient_llm_call, rag_pipeline, q)
-                        answer2 = (response2.get("result", "") or "").strip()
-                        if answer2 and answer2 != "Not found in the provided document.":
-                            response = response2
-                            answer = answer2
-                    except Exception:
-                        pass
-
-                # Clean citations:
-                #  - If the model mentioned pages in Evidence, keep only those pages
-                #  - Dedupe (source, page)
-                #  - Cap to 4 citations
-                pages_used = _pages_mentioned(answer)
-
-                seen = set()
-                citations = []
-                for d in response.get("source_documents", []) or []:
-                    md = d.metadata or {}
-                    src = md.get("source")
-                    page = _coerce_int(md.get("page"))
-
-                    if pages_used and page is not None and page not in pages_used:
-                        continue
-
-                    key = (src, page)
-                    if key in seen:
-                        continue
-                    seen.add(key)
-
-                    citations.append({"source": src, "page": page})
-                    if len(citations) == 4:
-                        break
-
-                # Fallback: if Evidence didn't include page numbers or filtering removed everything,
-                # take top 4 unique retrieved chunks.
-                if not citations:
-                    seen = set()
-                    for d in response.get("source_documents", []) or []:
-                        md = d.metadata or {}
-                        src = md.get("source")
-                        page = _coerce_int(md.get("page"))
-                        key = (src, page)
-                        if key in seen:
-                            continue
-                        seen.add(key)
-                        citations.append({"source": src, "page": page})
-                        if len(citations) == 4:
-                            break
-
-                results[q] = {
-                    "answer": answer if answer else "Not found in the provided document.",
-                    "citations": citations,
-                }
-
-            except Exception as e:
-                logger.error(f"LLM Error on question '{q}': {e}")
-                results[q] = {"answer": "Error: Service unavailable for this query.", "citations": []}
-
-        duration = time.time() - start_time
-        logger.info(json.dumps({
-            "event": "processed_request",
-            "duration_sec": duration,
-            "question_count": len(questions),
-        }))
-
-        return results
+            for next_done in asyncio.as_completed(tasks):
+                q, payload = await next_done
+                yield orjson.dumps({q: payload}) + b"\n"
+        finally:
+            # Client went away mid-stream: don't keep paying for the remaining answers
+            for t in [*tasks, *shared_answers.values()]:
+                t.cancel()
+
+            duration = time.time() - start_time
+            logger.info(orjson.dumps({
+                "event": "processed_request",
+                "duration_sec": duration,
+                "question_count": len(questions),
+            }).decode())
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
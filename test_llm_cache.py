@@ -0,0 +1,65 @@
+import numpy as np
+
+from llm_cache import LLMCache
+
+
+def vec(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def test_exact_hit_is_scoped_per_document():
+    cache = LLMCache()
+    cache.put("doc-a", "Q1", vec(1, 0, 0), {"result": "A"})
+
+    assert cache.get("doc-a", "Q1") == {"result": "A"}
+    assert cache.get("doc-b", "Q1") is None
+    assert cache.get("doc-a", "Q2") is None
+
+
+def test_semantic_hit_above_threshold_only():
+    cache = LLMCache(similarity_threshold=0.97)
+    cache.put("doc-a", "Which cloud providers do you use?", vec(1, 0, 0), {"result": "AWS"})
+
+    assert cache.get_similar("doc-a", vec(0.99, 0.05, 0)) == {"result": "AWS"}
+    assert cache.get_similar("doc-a", vec(0, 1, 0)) is None
+    assert cache.get_similar("doc-b", vec(1, 0, 0)) is None
+
+
+def test_exact_entries_evicted_lru():
+    cache = LLMCache(max_entries=2)
+    cache.put("d", "Q1", vec(1, 0, 0), {"result": "1"})
+    cache.put("d", "Q2", vec(0, 1, 0), {"result": "2"})
+    cache.get("d", "Q1")
+    cache.put("d", "Q3", vec(0, 0, 1), {"result": "3"})
+
+    assert cache.get("d", "Q2") is None
+    assert cache.get("d", "Q1") == {"result": "1"}
+
+
+def test_semantic_index_drops_oldest_when_full():
+    cache = LLMCache(max_similar_per_document=2)
+    cache.put("d", "Q1", vec(1, 0, 0), {"result": "1"})
+    cache.put("d", "Q2", vec(0, 1, 0), {"result": "2"})
+    cache.put("d", "Q3", vec(0, 0, 1), {"result": "3"})
+
+    assert cache.get_similar("d", vec(1, 0, 0)) is None
+    assert cache.get_similar("d", vec(0, 1, 0)) == {"result": "2"}
+    assert cache.get_similar("d", vec(0, 0, 1)) == {"result": "3"}
+
+
+def test_semantic_layer_bounded_independently_of_exact_cap():
+    cache = LLMCache(max_entries=1024, max_documents=2, max_similar_per_document=3)
+    rng = np.random.default_rng(0)
+    for doc in ("a", "b", "c"):
+        for i in range(10):
+            cache.put(doc, f"Q{i}", rng.standard_normal(8), {"result": i})
+
+    assert len(cache._semantic) == 2
+    assert all(index.ntotal == len(responses) == 3 for index, responses in cache._semantic.values())
+
+
+def test_group_similar_maps_near_duplicates_to_first_occurrence():
+    cache = LLMCache(similarity_threshold=0.97)
+    vectors = [vec(1, 0, 0), vec(0, 1, 0), vec(2, 0.01, 0), vec(0, 0, 1)]
+
+    assert cache.group_similar(vectors) == [0, 1, 0, 3]
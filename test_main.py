@@ -1,14 +1,57 @@
-import json
+import os
+import asyncio
 from unittest.mock import patch, MagicMock
 
+import numpy as np
+import orjson
+import pytest
 from fastapi.testclient import TestClient
 
+# The OpenAI client is constructed for real (but never called) in these tests
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import main
 from main import app
 from utils import MAX_QUESTIONS
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # Vector stores and answers are shared across requests by document hash; keep tests independent
+    main._STORE_CACHE.clear()
+    main.llm_cache.clear()
+    yield
+    main._STORE_CACHE.clear()
+    main.llm_cache.clear()
+
+
+def fake_embeddings(questions: list) -> np.ndarray:
+    # Deterministic per question; distinct questions are far apart (no accidental semantic cache hits)
+    return np.stack([np.random.default_rng(abs(hash(q))).standard_normal(64) for q in questions]).astype(np.float32)
+
+
+@pytest.fixture(autouse=True)
+def fake_retrieval():
+    # Endpoint tests mock the vector store, so skip the real embedding call and FAISS search
+    def fake_retrieve(retriever, question_vectors, search_kwargs=None):
+        return [[] for _ in np.asarray(question_vectors).reshape(-1, 64)]
+
+    with patch("main.embed_questions", side_effect=fake_embeddings) as mock_embed, \
+            patch("main.retrieve_documents", side_effect=fake_retrieve) as mock_retrieve:
+        yield mock_embed, mock_retrieve
+
+
+def read_answers(response) -> dict:
+    """/answer streams one {question: payload} JSON object per line."""
+    answers = {}
+    for line in response.text.splitlines():
+        if line:
+            answers.update(orjson.loads(line))
+    return answers
+
+
 def test_health():
     response = client.get("/health")
     assert response.status_code == 200
@@ -57,7 +100,7 @@ def test_no_questions_returns_400():
 
 def test_non_string_questions_returns_400():
     files = {
-        "questions_file": ("q.json", json.dumps([1, 2, 3]), "application/json"),
+        "questions_file": ("q.json", orjson.dumps([1, 2, 3]), "application/json"),
         "document_file": ("doc.json", "{}", "application/json"),
     }
     response = client.post("/answer", files=files)
@@ -68,7 +111,7 @@ def test_non_string_questions_returns_400():
 def test_too_many_questions_returns_400():
     too_many = [f"Q{i}" for i in range(MAX_QUESTIONS + 1)]
     files = {
-        "questions_file": ("q.json", json.dumps(too_many), "application/json"),
+        "questions_file": ("q.json", orjson.dumps(too_many), "application/json"),
         "document_file": ("doc.json", "{}", "application/json"),
     }
     response = client.post("/answer", files=files)
@@ -76,24 +119,38 @@ def test_too_many_questions_returns_400():
     assert "Too many questions" in response.json()["detail"]
 
 
+def test_oversized_request_rejected_before_reading_body():
+    files = {
+        "questions_file": ("q.json", orjson.dumps(["Q1"]), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+    with patch("main.MAX_REQUEST_SIZE_BYTES", 10):
+        response = client.post("/answer", files=files)
+    assert response.status_code == 413
+    assert "Request too large" in response.json()["detail"]
+
+
 # IMPORTANT:
 # main.py imports these symbols directly:
-#   from rag_engine import process_file_sync, build_rag_pipeline, resilient_llm_call
+#   from rag_engine import process_file_sync, load_cached_knowledge_base,
+#                          build_knowledge_base, build_retriever, answer_question
 # so you MUST patch "main.<name>", not "rag_engine.<name>".
 
 
-@patch("main.resilient_llm_call")
-@patch("main.build_rag_pipeline")
+@patch("main.answer_question")
+@patch("main.build_retriever")
 @patch("main.process_file_sync")
-def test_answer_happy_path_with_mocks(mock_process, mock_build, mock_llm):
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_answer_happy_path_with_mocks(mock_load, mock_kb, mock_process, mock_build, mock_llm):
     # Arrange: avoid real parsing/embeddings/LLM calls
     mock_process.return_value = ["dummy_doc"]
     mock_build.return_value = object()
 
     d1 = MagicMock()
-    d1.metadata = {"source": "source_doc.pdf", "page": 2}
+    d1.metadata = {"page": 2}
     d2 = MagicMock()
-    d2.metadata = {"source": "source_doc.pdf", "page": 5}
+    d2.metadata = {"page": 5}
 
     mock_llm.return_value = {
         "result": "Mocked answer",
@@ -102,8 +159,8 @@ def test_answer_happy_path_with_mocks(mock_process, mock_build, mock_llm):
 
     questions = ["What is this doc about?"]
     files = {
-        "questions_file": ("q.json", json.dumps(questions), "application/json"),
-        "document_file": ("doc.json", json.dumps({"hello": "world"}), "application/json"),
+        "questions_file": ("q.json", orjson.dumps(questions), "application/json"),
+        "document_file": ("doc.json", orjson.dumps({"hello": "world"}), "application/json"),
     }
 
     # Act
@@ -111,13 +168,14 @@ def test_answer_happy_path_with_mocks(mock_process, mock_build, mock_llm):
 
     # Assert
     assert response.status_code == 200
-    body = response.json()
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    body = read_answers(response)
 
     assert "What is this doc about?" in body
     assert body["What is this doc about?"]["answer"] == "Mocked answer"
     assert body["What is this doc about?"]["citations"] == [
-        {"source": "source_doc.pdf", "page": 2},
-        {"source": "source_doc.pdf", "page": 5},
+        {"source": "doc.json", "page": 2},
+        {"source": "doc.json", "page": 5},
     ]
 
     assert mock_process.called
@@ -125,22 +183,292 @@ def test_answer_happy_path_with_mocks(mock_process, mock_build, mock_llm):
     assert mock_llm.called
 
 
-@patch("main.resilient_llm_call", side_effect=Exception("boom"))
-@patch("main.build_rag_pipeline")
+@patch("main.answer_question", side_effect=Exception("boom"))
+@patch("main.build_retriever")
 @patch("main.process_file_sync")
-def test_llm_failure_is_handled_per_question(mock_process, mock_build, mock_llm):
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_llm_failure_is_handled_per_question(mock_load, mock_kb, mock_process, mock_build, mock_llm):
     mock_process.return_value = ["dummy_doc"]
     mock_build.return_value = object()
 
     questions = ["Q1"]
     files = {
-        "questions_file": ("q.json", json.dumps(questions), "application/json"),
+        "questions_file": ("q.json", orjson.dumps(questions), "application/json"),
         "document_file": ("doc.json", "{}", "application/json"),
     }
 
     response = client.post("/answer", files=files)
     assert response.status_code == 200
-    body = response.json()
+    body = read_answers(response)
 
     assert body["Q1"]["answer"].startswith("Error:")
     assert body["Q1"]["citations"] == []
+
+
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_multiple_questions_answered_independently(mock_load, mock_kb, mock_process, mock_build, mock_llm):
+    mock_process.return_value = ["dummy_doc"]
+    mock_build.return_value = object()
+
+    def fake_llm(openai_client, question, docs, source_name="document"):
+        if question == "Q2":
+            raise Exception("boom")
+        return {"result": f"Answer to {question}", "source_documents": []}
+
+    mock_llm.side_effect = fake_llm
+
+    questions = ["Q1", "Q2", "Q3"]
+    files = {
+        "questions_file": ("q.json", orjson.dumps(questions), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+
+    response = client.post("/answer", files=files)
+    assert response.status_code == 200
+    body = read_answers(response)
+
+    assert body["Q1"]["answer"] == "Answer to Q1"
+    assert body["Q2"]["answer"].startswith("Error:")
+    assert body["Q3"]["answer"] == "Answer to Q3"
+    assert mock_llm.call_count == 3
+
+
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base")
+def test_cached_index_skips_document_processing(mock_load, mock_kb, mock_process, mock_build, mock_llm):
+    mock_load.return_value = object()
+    mock_build.return_value = object()
+    mock_llm.return_value = {"result": "Cached answer", "source_documents": []}
+
+    files = {
+        "questions_file": ("q.json", orjson.dumps(["Q1"]), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+
+    response = client.post("/answer", files=files)
+    assert response.status_code == 200
+    assert read_answers(response)["Q1"]["answer"] == "Cached answer"
+
+    assert mock_load.called
+    assert not mock_process.called
+    assert not mock_kb.called
+    mock_build.assert_called_once_with(mock_load.return_value)
+
+
+@pytest.mark.parametrize("pages, expected_calls", [([1, 2, 3, 4], 1), ([7, 7, 7], 2)])
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_not_found_retried_only_when_retrieval_is_sparse(
+    mock_load, mock_kb, mock_process, mock_build, mock_llm, pages, expected_calls
+):
+    mock_process.return_value = ["dummy_doc"]
+    mock_build.return_value = MagicMock(search_kwargs={"k": 10, "fetch_k": 25})
+
+    docs = []
+    for page in pages:
+        d = MagicMock()
+        d.metadata = {"page": page}
+        docs.append(d)
+    mock_llm.return_value = {"result": "Not found in the provided document.", "source_documents": docs}
+
+    files = {
+        "questions_file": ("q.json", orjson.dumps(["Q1"]), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+
+    response = client.post("/answer", files=files)
+    assert response.status_code == 200
+    assert read_answers(response)["Q1"]["answer"] == "Not found in the provided document."
+    assert mock_llm.call_count == expected_calls
+
+
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_repeated_question_served_from_answer_cache(mock_load, mock_kb, mock_process, mock_build, mock_llm):
+    mock_process.return_value = ["dummy_doc"]
+    mock_build.return_value = object()
+    mock_llm.return_value = {"result": "Cached once", "source_documents": []}
+
+    files = {
+        "questions_file": ("q.json", orjson.dumps(["Q1"]), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+
+    first = read_answers(client.post("/answer", files=files))
+    second = read_answers(client.post("/answer", files=files))
+
+    assert first == second
+    assert second["Q1"]["answer"] == "Cached once"
+    assert mock_llm.call_count == 1
+
+
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_duplicate_questions_in_batch_answered_once(mock_load, mock_kb, mock_process, mock_build, mock_llm,
+                                                    fake_retrieval):
+    mock_embed, mock_retrieve = fake_retrieval
+    # "Q1 ?" embeds like "Q1": near-duplicates share one answer within the batch, not only across requests
+    mock_embed.side_effect = lambda questions: fake_embeddings([q.rstrip(" ?") for q in questions])
+    mock_process.return_value = ["dummy_doc"]
+    mock_build.return_value = object()
+    mock_llm.return_value = {"result": "Answered once", "source_documents": []}
+
+    files = {
+        "questions_file": ("q.json", orjson.dumps(["Q1", "Q1", "Q1 ?", "Q2"]), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+    response = client.post("/answer", files=files)
+
+    lines = [line for line in response.text.splitlines() if line]
+    assert len(lines) == 3
+    answers = read_answers(response)
+    assert answers["Q1"] == answers["Q1 ?"]
+    assert [c.args[1] for c in mock_llm.call_args_list] in (["Q1", "Q2"], ["Q2", "Q1"])
+    assert len(mock_retrieve.call_args.args[1]) == 2
+
+
+def test_concurrent_requests_for_same_document_build_once():
+    builds = []
+
+    async def build():
+        builds.append(1)
+        await asyncio.sleep(0.01)
+        return "store"
+
+    async def run():
+        return await asyncio.gather(*(main._get_knowledge_base("h", build) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["store"] * 5
+    assert len(builds) == 1
+
+
+def test_failed_build_is_not_cached():
+    async def failing_build():
+        raise RuntimeError("boom")
+
+    async def build():
+        return "store"
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main._get_knowledge_base("h", failing_build))
+    assert "h" not in main._STORE_CACHE
+    assert asyncio.run(main._get_knowledge_base("h", build)) == "store"
+
+
+def test_store_cache_evicts_least_recently_used():
+    async def build():
+        return "store"
+
+    async def run():
+        for doc_hash in ["a", "b", "a", "c"]:
+            await main._get_knowledge_base(doc_hash, build)
+
+    with patch("main.MAX_CACHED_STORES", 2):
+        asyncio.run(run())
+    assert list(main._STORE_CACHE) == ["a", "c"]
+
+
+def test_store_built_while_others_are_used_is_not_evicted():
+    builds = []
+    release_x = None
+
+    def build_for(doc_hash):
+        async def build():
+            builds.append(doc_hash)
+            if doc_hash == "X":
+                await release_x.wait()
+            return f"store-{doc_hash}"
+        return build
+
+    async def run():
+        nonlocal release_x
+        release_x = asyncio.Event()
+        for doc_hash in ["a", "b"]:
+            await main._get_knowledge_base(doc_hash, build_for(doc_hash))
+
+        building = asyncio.ensure_future(main._get_knowledge_base("X", build_for("X")))
+        waiting = asyncio.ensure_future(main._get_knowledge_base("X", build_for("X")))
+        await asyncio.sleep(0)
+
+        # Other stores are used while X is still building
+        for doc_hash in ["a", "b"]:
+            await main._get_knowledge_base(doc_hash, build_for(doc_hash))
+        release_x.set()
+        return await building, await waiting
+
+    with patch("main.MAX_CACHED_STORES", 2):
+        assert asyncio.run(run()) == ("store-X", "store-X")
+    assert builds == ["a", "b", "X"]
+    assert list(main._STORE_CACHE) == ["b", "X"]
+
+
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_questions_embedded_and_retrieved_in_one_batch(
+    mock_load, mock_kb, mock_process, mock_build, mock_llm, fake_retrieval
+):
+    mock_embed, mock_retrieve = fake_retrieval
+    mock_process.return_value = ["dummy_doc"]
+    mock_build.return_value = object()
+    mock_llm.return_value = {"result": "Yes", "source_documents": []}
+
+    questions = ["Q1", "Q2", "Q3"]
+    files = {
+        "questions_file": ("q.json", orjson.dumps(questions), "application/json"),
+        "document_file": ("doc.json", "{}", "application/json"),
+    }
+
+    response = client.post("/answer", files=files)
+    assert response.status_code == 200
+    assert set(read_answers(response)) == set(questions)
+
+    mock_embed.assert_called_once_with(questions)
+    mock_retrieve.assert_called_once()
+    assert mock_retrieve.call_args.args[1].shape == (3, 64)
+    assert mock_llm.call_count == 3
+
+
+@patch("main.answer_question")
+@patch("main.build_retriever")
+@patch("main.process_file_sync")
+@patch("main.build_knowledge_base")
+@patch("main.load_cached_knowledge_base", return_value=None)
+def test_cached_document_cited_under_each_uploads_filename(mock_load, mock_kb, mock_process, mock_build, mock_llm):
+    mock_process.return_value = ["dummy_doc"]
+    mock_build.return_value = object()
+    doc = MagicMock()
+    doc.metadata = {"page": 3}
+    mock_llm.return_value = {"result": "Yes", "source_documents": [doc]}
+
+    def upload(name):
+        files = {
+            "questions_file": ("q.json", orjson.dumps(["Q1"]), "application/json"),
+            "document_file": (name, b"{}", "application/json"),
+        }
+        return read_answers(client.post("/answer", files=files))["Q1"]["citations"]
+
+    # Same bytes: the second upload reuses the in-memory store but must not inherit the first name
+    assert upload("policy_v1.json") == [{"source": "policy_v1.json", "page": 3}]
+    assert upload("SOC2_report.json") == [{"source": "SOC2_report.json", "page": 3}]
+    assert mock_kb.call_count == 1
+    assert mock_llm.call_args.args[3] == "SOC2_report.json"
@@ -0,0 +1,217 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import faiss
+import httpx
+import numpy as np
+import openai
+import pymupdf
+import pytest
+from fastapi import HTTPException
+from langchain_community.embeddings import FakeEmbeddings
+from langchain_core.documents import Document
+from tenacity import wait_none
+
+import rag_engine
+from rag_engine import (
+    process_file_sync,
+    answer_question,
+    build_knowledge_base,
+    build_retriever,
+    retrieve_documents,
+    load_cached_knowledge_base,
+    _build_faiss_index,
+    _index_vectors,
+)
+
+
+def test_json_document_passed_through_as_raw_text(tmp_path):
+    raw = '{"controls": [{"id": 1, "name": "MFA"}],\n "owner": "security"}'
+    path = tmp_path / "doc.json"
+    path.write_text(raw, encoding="utf-8")
+
+    docs = process_file_sync(str(path), ".json")
+
+    assert len(docs) == 1
+    assert docs[0].page_content == raw
+    assert docs[0].metadata == {}  # no upload name in shared, content-addressed indexes
+
+
+def test_corrupt_json_document_rejected(tmp_path):
+    path = tmp_path / "doc.json"
+    path.write_bytes(b'{"controls": [')
+
+    with pytest.raises(HTTPException) as e:
+        process_file_sync(str(path), ".json")
+    assert e.value.status_code == 400
+    assert "Corrupt JSON" in e.value.detail
+
+
+def test_dead_parser_worker_reported_as_server_error(tmp_path):
+    path = tmp_path / "doc.pdf"
+    with pymupdf.open() as pdf:
+        pdf.new_page()
+        pdf.save(str(path))
+
+    with patch("rag_engine.run_cpu_tasks", side_effect=BrokenProcessPool("worker died")):
+        with pytest.raises(HTTPException) as e:
+            process_file_sync(str(path), ".pdf")
+    assert e.value.status_code == 503
+
+
+def test_dead_splitter_worker_reported_as_server_error():
+    with patch("rag_engine.run_cpu_task", side_effect=BrokenProcessPool("worker died")):
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(build_knowledge_base([]))
+    assert e.value.status_code == 503
+
+
+def make_client(side_effect) -> MagicMock:
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(side_effect=side_effect)
+    return client
+
+
+def make_completion(content: str) -> MagicMock:
+    completion = MagicMock()
+    completion.choices[0].message.content = content
+    completion.usage = None
+    return completion
+
+
+def test_answer_question_labels_context_with_request_source_name():
+    client = make_client([make_completion("Yes")])
+    docs = [Document(page_content="MFA is enforced.", metadata={"page": 4})]
+
+    asyncio.run(answer_question(client, "Q1", docs, "SOC2_report.pdf"))
+
+    user_message = client.chat.completions.create.await_args.kwargs["messages"][1]["content"]
+    assert "(source=SOC2_report.pdf, page=4)\nMFA is enforced." in user_message
+
+
+def test_answer_question_fails_fast_on_permanent_errors():
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    error = openai.BadRequestError("context too long", response=httpx.Response(400, request=request), body=None)
+    client = make_client(error)
+
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(answer_question(client, "Q1", []))
+    assert client.chat.completions.create.await_count == 1
+
+
+def test_answer_question_retries_transient_errors():
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    client = make_client([openai.APITimeoutError(request=request), make_completion("Yes")])
+
+    response = asyncio.run(answer_question.retry_with(wait=wait_none())(client, "Q1", []))
+    assert response["result"] == "Yes"
+    assert client.chat.completions.create.await_count == 2
+
+
+DIM = 64  # divisible by IVFPQ_M, so large documents take the IVFPQ tier
+# One size per _build_faiss_index tier: flat fp16 (<= FLAT_MAX_CHUNKS), HNSW fp16, IVFPQ (> IVFPQ_MIN_CHUNKS)
+TIERS = [(200, faiss.IndexScalarQuantizer), (1500, faiss.IndexHNSWSQ), (2500, faiss.IndexIVFPQ)]
+
+
+def unit_vectors(n: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+@pytest.fixture
+def offline_store(tmp_path, monkeypatch):
+    """Build (and persist) a real FAISS store from given vectors, with no embeddings API behind it."""
+    monkeypatch.setattr(rag_engine, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(rag_engine, "get_embeddings_model", lambda: FakeEmbeddings(size=DIM))
+
+    def build(vectors: np.ndarray, doc_hash: str = "doc"):
+        texts = [f"chunk {i}" for i in range(len(vectors))]
+        metadatas = [{"page": i} for i in range(len(vectors))]
+        return _index_vectors(texts, vectors, metadatas, doc_hash)
+
+    return build
+
+
+@pytest.mark.parametrize("num_vectors, index_type", TIERS)
+def test_faiss_index_tier_by_document_size(num_vectors, index_type):
+    vectors = unit_vectors(num_vectors)
+    index = _build_faiss_index(vectors)
+    index.add(vectors)
+
+    assert type(index) is index_type
+    assert index.metric_type == faiss.METRIC_INNER_PRODUCT
+    # MMR re-ranks candidates from their stored vectors
+    assert index.reconstruct(0).shape == (DIM,)
+
+    exact = faiss.IndexFlatIP(DIM)
+    exact.add(vectors)
+    queries = vectors[:50] + 0.1 * unit_vectors(50, seed=1)
+    found, expected = index.search(queries, 10)[1], exact.search(queries, 10)[1]
+    recall = np.mean([len(set(f) & set(e)) / 10 for f, e in zip(found, expected)])
+    top1 = np.mean(found[:, 0] == expected[:, 0])
+
+    if index_type is faiss.IndexIVFPQ:
+        # Lossy 32-byte codes: ranking is approximate, but the nearest chunk is still found
+        assert top1 >= 0.9 and recall >= 0.4
+    else:
+        # fp16 storage: effectively exact
+        assert top1 >= 0.98 and recall >= 0.95
+
+
+@pytest.mark.parametrize("num_vectors", [n for n, _ in TIERS])
+def test_batched_retrieval_matches_langchain_mmr(offline_store, num_vectors):
+    built = offline_store(unit_vectors(num_vectors))
+    reloaded = load_cached_knowledge_base("doc")
+    assert reloaded is not None
+
+    queries = unit_vectors(5, seed=2)
+    for knowledge_base in (built, reloaded):
+        retriever = build_retriever(knowledge_base)
+        for search_kwargs in (None, {"k": 16, "fetch_k": 80}):
+            batched = retrieve_documents(retriever, queries, search_kwargs)
+            assert len(batched) == len(queries)
+
+            kwargs = {**retriever.search_kwargs, **(search_kwargs or {})}
+            for query, docs in zip(queries, batched):
+                expected = knowledge_base.max_marginal_relevance_search_by_vector(query.tolist(), **kwargs)
+                assert [d.page_content for d in docs] == [d.page_content for d in expected]
+                assert len(docs) == kwargs["k"]
+
+
+def test_index_cache_pruned_least_recently_used_first(offline_store, monkeypatch):
+    monkeypatch.setattr(rag_engine, "MAX_CACHED_INDEXES", 2)
+    for age, doc_hash in enumerate(["b", "a"]):
+        offline_store(unit_vectors(20), doc_hash)
+        os.utime(rag_engine._index_cache_path(doc_hash), (1000 + age, 1000 + age))
+
+    # A cache hit refreshes "b", so building "c" evicts "a"
+    assert load_cached_knowledge_base("b") is not None
+    offline_store(unit_vectors(20), "c")
+
+    assert load_cached_knowledge_base("a") is None
+    assert load_cached_knowledge_base("b") is not None
+    assert load_cached_knowledge_base("c") is not None
+
+
+@pytest.mark.parametrize("on_gpu", [False, True])
+def test_retrieval_serialized_on_gpu_indexes_only(offline_store, monkeypatch, on_gpu):
+    retriever = build_retriever(offline_store(unit_vectors(50)))
+    if on_gpu:
+        # Stand-in for a faiss-gpu build: treat this index type as a GPU index
+        monkeypatch.setattr(faiss, "GpuIndex", type(retriever.vectorstore.index), raising=False)
+
+    with ThreadPoolExecutor(max_workers=1) as pool, rag_engine._GPU_LOCK:
+        future = pool.submit(retrieve_documents, retriever, unit_vectors(2, seed=3))
+        done, _ = wait([future], timeout=0.5)
+        assert bool(done) is not on_gpu
+    assert len(future.result(timeout=5)) == 2
+
+
+def test_batched_retrieval_accepts_a_single_question_vector(offline_store):
+    retriever = build_retriever(offline_store(unit_vectors(50)))
+    docs = retrieve_documents(retriever, unit_vectors(1, seed=3)[0])
+    assert len(docs) == 1 and len(docs[0]) == 10
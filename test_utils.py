@@ -1,9 +1,21 @@
 import io
+import os
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
 import pytest
 from starlette.datastructures import UploadFile as StarletteUploadFile
 from fastapi import HTTPException
 
-from utils import validate_file, validate_questions_file
+import utils
+from utils import (
+    validate_file,
+    validate_questions_file,
+    save_and_validate,
+    read_and_validate,
+    content_hash,
+    prune_oldest,
+)
 
 
 def make_upload(filename: str, content: bytes) -> StarletteUploadFile:
@@ -17,6 +29,16 @@ def test_validate_file_rejects_bad_extension():
     assert e.value.status_code == 400
 
 
+def test_validate_file_extension_case_insensitive():
+    assert validate_file(make_upload("Report.Final.PDF", b"%PDF-1.4")) == ".pdf"
+
+
+def test_validate_file_rejects_missing_extension():
+    with pytest.raises(HTTPException) as e:
+        validate_file(make_upload("README", b"hi"))
+    assert e.value.status_code == 400
+
+
 def test_validate_questions_file_requires_json():
     f = make_upload("q.pdf", b"%PDF-1.4")
     with pytest.raises(HTTPException) as e:
@@ -24,10 +46,77 @@ def test_validate_questions_file_requires_json():
     assert e.value.status_code == 400
 
 
-def test_validate_file_size_limit():
+def test_save_and_validate_size_limit(tmp_path):
     big = b"a" * (51 * 1024 * 1024)  # 51MB
-    f = make_upload("x.json", big)
+    dest = tmp_path / "x.json"
     with pytest.raises(HTTPException) as e:
-        validate_file(f, max_mb=50)
+        asyncio.run(save_and_validate(make_upload("x.json", big), str(dest), max_mb=50))
     assert e.value.status_code == 400
     assert "File too large" in e.value.detail
+    assert not dest.exists()
+
+
+def test_read_and_validate_size_limit():
+    big = b"a" * (6 * 1024 * 1024)  # 6MB
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(read_and_validate(make_upload("q.json", big), max_mb=5))
+    assert e.value.status_code == 400
+    assert "File too large" in e.value.detail
+
+
+def test_save_and_validate_returns_content_hash(tmp_path):
+    content = b"%PDF-1.4 some bytes"
+    dest = tmp_path / "doc.pdf"
+    digest = asyncio.run(save_and_validate(make_upload("doc.pdf", content), str(dest)))
+    assert dest.read_bytes() == content
+    assert digest == content_hash(content)
+
+
+def test_save_and_validate_reports_open_failure(tmp_path):
+    dest = tmp_path / "missing_dir" / "doc.pdf"
+    with pytest.raises(OSError) as e:
+        asyncio.run(save_and_validate(make_upload("doc.pdf", b"%PDF-1.4"), str(dest)))
+    # The open() error itself surfaces, not a second error from cleaning up a file that was never created
+    assert e.value.__context__ is None
+
+
+def test_prune_oldest_keeps_most_recently_modified(tmp_path):
+    for age, name in enumerate(["newest", "middle", "oldest"]):
+        entry = tmp_path / name
+        if name == "middle":
+            entry.mkdir()
+            (entry / "index.faiss").write_bytes(b"x")
+        else:
+            entry.write_bytes(b"x")
+        os.utime(entry, (1000 - age, 1000 - age))
+
+    assert prune_oldest(str(tmp_path), keep=2) == 1
+    assert sorted(os.listdir(tmp_path)) == ["middle", "newest"]
+    assert prune_oldest(str(tmp_path), keep=1) == 1
+    assert os.listdir(tmp_path) == ["newest"]
+    assert prune_oldest(str(tmp_path / "missing"), keep=1) == 0
+
+
+def test_cpu_pool_rebuilt_after_worker_dies():
+    broken = utils.cpu_executor
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+
+    assert utils.run_cpu_tasks(abs, [(-3,), (4,)]) == [3, 4]
+    assert utils.cpu_executor is not broken
+
+
+def test_cpu_task_that_kills_its_worker_fails_but_leaves_a_working_pool():
+    with pytest.raises(BrokenProcessPool):
+        utils.run_cpu_tasks(os._exit, [(1,)])
+
+    assert utils.run_cpu_tasks(abs, [(-1,)]) == [1]
+
+
+def test_async_cpu_task_retried_on_rebuilt_pool():
+    broken = utils.cpu_executor
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+
+    assert asyncio.run(utils.run_cpu_task(abs, -5)) == 5
+    assert utils.cpu_executor is not broken
@@ -1,51 +1,182 @@
 import os
-import logging
 import shutil
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import logging
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable
+
+import anyio
+import xxhash
 from fastapi import UploadFile, HTTPException
+from pythonjsonlogger.orjson import OrjsonFormatter
 
 # --- 1. OBSERVABILITY (JSON LOGGING) ---
-logging.basicConfig(
-    level=logging.INFO,
-    format='{"timestamp": "%(asctime)s", "level": "%(levelname)s", "message": "%(message)s"}'
-)
+# Real JSON serializer (orjson): quotes, newlines and tracebacks in messages are escaped properly
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(OrjsonFormatter(
+    "%(asctime)s %(levelname)s %(message)s",
+    rename_fields={"asctime": "timestamp", "levelname": "level"},
+))
 logger = logging.getLogger("zania-bot")
+logger.setLevel(logging.INFO)
+logger.addHandler(_log_handler)
+logger.propagate = False  # don't emit twice if the server also configures the root logger
 
 # --- 2. CONFIG ---
 MAX_FILE_SIZE_MB = 50
-ALLOWED_EXTENSIONS = {".pdf", ".json"}
+MAX_QUESTIONS_FILE_SIZE_MB = 5
+# Both files plus multipart framing; checked against Content-Length before the body is read
+MAX_REQUEST_SIZE_MB = MAX_FILE_SIZE_MB + MAX_QUESTIONS_FILE_SIZE_MB + 1
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
+ALLOWED_EXTENSIONS = frozenset({".pdf", ".json"})
 MAX_QUESTIONS = 50  # Fix #5: limit number of questions
+MAX_CONCURRENT_LLM_CALLS = 8  # in-flight OpenAI calls per request
+CACHE_DIR = os.getenv("ZANIA_CACHE_DIR", "cache")  # persisted indexes + chunk embeddings
+MAX_CACHED_STORES = 8  # vector stores kept in memory (LRU); bounds RAM held by idle documents
+# On-disk caches under CACHE_DIR, pruned oldest-first (by mtime) whenever a new index is built
+MAX_CACHED_INDEXES = int(os.getenv("ZANIA_MAX_CACHED_INDEXES", "256"))  # persisted document indexes (LRU)
+MAX_CACHED_EMBEDDINGS = int(os.getenv("ZANIA_MAX_CACHED_EMBEDDINGS", "50000"))  # chunk embeddings (~35KB each)
 
 # --- 3. CONCURRENCY HELPER ---
-executor = ThreadPoolExecutor(max_workers=4)
+# Blocking file/index I/O. OpenAI calls are native async and don't hold a thread, so stdlib default sizing
+io_executor = ThreadPoolExecutor()
 
-def save_upload_to_path(upload: UploadFile, path: str) -> None:
-    """Save UploadFile to disk safely (ensures the file handle is closed)."""
-    with open(path, "wb") as out:
-        shutil.copyfileobj(upload.file, out)
+def _new_cpu_executor() -> ProcessPoolExecutor:
+    # forkserver/spawn rather than fork: this process already runs threads (event loop, io_executor, anyio),
+    # and a forked worker could inherit one of their locks mid-acquire
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
 
-def validate_file(file: UploadFile, max_mb: int = MAX_FILE_SIZE_MB) -> str:
-    """Enforce file size and type limits for general uploads (PDF/JSON docs)."""
-    filename = file.filename or "unknown"
-    ext = os.path.splitext(filename)[1].lower()
+# CPU-bound work (PDF text extraction, text splitting) runs in separate processes so it doesn't contend on the GIL.
+# Submit through run_cpu_tasks: a dead worker breaks the whole pool, and it is replaced there.
+cpu_executor = _new_cpu_executor()
+_cpu_executor_lock = threading.Lock()
 
-    if ext not in ALLOWED_EXTENSIONS:
-        raise HTTPException(status_code=400, detail=f"Unsupported file type: {ext}. Use PDF or JSON.")
+def _replace_broken_cpu_executor(broken: ProcessPoolExecutor) -> None:
+    global cpu_executor
+    with _cpu_executor_lock:
+        if cpu_executor is broken:  # another caller may have replaced it already
+            cpu_executor = _new_cpu_executor()
+            logger.error("cpu_executor worker died; process pool rebuilt")
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def run_cpu_tasks(fn: Callable, arg_tuples: Iterable[tuple]) -> list:
+    """
+    Run fn(*args) in cpu_executor for each args tuple; returns the results in order. Blocking: call from a thread.
+    If a worker died (BrokenProcessPool) the pool is rebuilt and the batch retried once. A second failure
+    (e.g. the same input crashing a worker again) propagates, but still leaves a fresh pool for later requests.
+    """
+    arg_tuples = list(arg_tuples)
+    for attempt in range(2):
+        pool = cpu_executor
+        try:
+            futures = [pool.submit(fn, *args) for args in arg_tuples]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            _replace_broken_cpu_executor(pool)
+            if attempt:
+                raise
+
+async def run_cpu_task(fn: Callable, *args):
+    """Async counterpart of run_cpu_tasks for a single call: same rebuild-and-retry-once on a dead worker."""
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = cpu_executor
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            _replace_broken_cpu_executor(pool)
+            if attempt:
+                raise
+
+async def _iter_upload(upload: UploadFile, max_mb: int):
+    """Yield the upload in UPLOAD_CHUNK_SIZE chunks, rejecting it as soon as the running total passes max_mb."""
+    total = 0
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        total += len(chunk)
+        if total > max_mb * 1024 * 1024:
+            raise HTTPException(status_code=400, detail=f"File too large. Limit is {max_mb}MB")
+        yield chunk
+
+def content_hash(data: bytes) -> str:
+    """
+    Cache key for uploaded content. xxh3-128 is non-cryptographic but collision-free in practice at
+    this scale and an order of magnitude faster than SHA-256; the keys only address server-side caches.
+    """
+    return xxhash.xxh3_128_hexdigest(data)
 
-    # Check size by seeking to the end
-    file.file.seek(0, os.SEEK_END)
-    size_in_bytes = file.file.tell()
-    file.file.seek(0)  # Reset cursor to start
+def prune_oldest(directory: str, keep: int) -> int:
+    """
+    Delete all but the `keep` most recently modified entries (files or directories) of directory.
+    Safe to run concurrently: entries already removed by another caller are skipped. Returns the number removed.
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = [(e.stat(follow_symlinks=False).st_mtime, e.path, e.is_dir(follow_symlinks=False)) for e in it]
+    except FileNotFoundError:
+        return 0
+    if len(entries) <= keep:
+        return 0
 
-    if size_in_bytes > max_mb * 1024 * 1024:
-        raise HTTPException(status_code=400, detail=f"File too large. Limit is {max_mb}MB")
+    entries.sort()
+    removed = 0
+    for _, path, is_dir in entries[:len(entries) - keep]:
+        try:
+            if is_dir:
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+def _write_chunk(out, digest, chunk: bytes) -> None:
+    digest.update(chunk)
+    out.write(chunk)
+
+async def save_and_validate(upload: UploadFile, path: str, max_mb: int = MAX_FILE_SIZE_MB) -> str:
+    """
+    Stream the upload to disk, enforcing the size cap while copying (no seek/tell pass over the whole file).
+    Returns the content_hash of the contents (computed incrementally). A rejected file is removed.
+    """
+    digest = xxhash.xxh3_128()
+    try:
+        with open(path, "wb") as out:
+            async for chunk in _iter_upload(upload, max_mb):
+                await anyio.to_thread.run_sync(_write_chunk, out, digest, chunk)
+    except BaseException:
+        # open() itself may have failed; don't let a missing file mask the original error
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        raise
+    return digest.hexdigest()
+
+async def read_and_validate(upload: UploadFile, max_mb: int = MAX_QUESTIONS_FILE_SIZE_MB) -> bytes:
+    """Read a small upload into memory, enforcing the size cap while reading."""
+    return b"".join([chunk async for chunk in _iter_upload(upload, max_mb)])
+
+def _extension(filename: str) -> str:
+    # Lowercased text from the last dot (a single rfind; no splitext path handling needed for an upload name)
+    dot = filename.rfind(".")
+    return filename[dot:].lower() if dot >= 0 else ""
+
+def validate_file(file: UploadFile) -> str:
+    """Enforce the file type for general uploads (PDF/JSON docs). Size is enforced while the upload is read."""
+    ext = _extension(file.filename or "unknown")
+
+    if ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {ext}. Use PDF or JSON.")
 
     return ext
 
-def validate_questions_file(file: UploadFile, max_mb: int = 5) -> str:
-    """Fix #3: questions_file must be JSON (not PDF). Keep a smaller size cap."""
-    filename = file.filename or "questions.json"
-    ext = os.path.splitext(filename)[1].lower()
+def validate_questions_file(file: UploadFile) -> str:
+    """Fix #3: questions_file must be JSON (not PDF). Its smaller size cap applies in read_and_validate."""
+    ext = _extension(file.filename or "questions.json")
     if ext != ".json":
         raise HTTPException(status_code=400, detail="questions_file must be a JSON file.")
-    return validate_file(file, max_mb=max_mb)
+    return ext